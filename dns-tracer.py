@@ -1,12 +1,26 @@
+import asyncio
+import gzip
 import logging
+import math
 import os
-import threading
+import socket
+import struct
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
 
+import dns.entropy
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdatatype
 import dns.resolver
 import yaml
-from prometheus_client import Counter, Gauge, start_http_server
+from prometheus_client import REGISTRY, Counter, Gauge
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.exposition import choose_encoder, gzip_accepted
+from prometheus_client.registry import Collector
 
 CONFIG_FILE = os.environ.get("DNS_EXPORTER_CONFIG", "config.yaml")
 
@@ -19,104 +33,308 @@ logger = logging.getLogger("dnstrace-exporter")
 
 
 # --- Config validation ---
+# section -> (required, fields every item in the section must have)
+CONFIG_SCHEMA = {
+    "servers": (True, ["name", "address"]),
+    "queries": (True, ["name", "type"]),
+    "entrypoints": (False, ["name", "address"]),
+}
+# field -> (minimum, maximum) accepted value; None means unbounded
+INTEGER_FIELDS = {
+    "interval": (1, None),
+    "listen_port": (1, 65535),
+    "cache_max_ttl": (0, None),
+    "max_concurrency": (1, None),
+}
+# field -> smallest accepted value. A probe resends every probe_timeout
+# seconds, so this floor caps it at 20 sends per second per probe
+NUMBER_FIELDS = {"probe_timeout": 0.05, "probe_total_timeout": 0.05}
+
+
+def parse_name(name):
+    """Parse a query name from config; only strings are accepted"""
+    if not isinstance(name, str):
+        raise TypeError(f"expected a string, got {type(name).__name__}")
+    return dns.name.from_text(name)
+
+
+def parse_type(qtype):
+    """Parse a query type from config; only strings are accepted"""
+    if not isinstance(qtype, str):
+        raise TypeError(f"expected a string, got {type(qtype).__name__}")
+    return dns.rdatatype.from_text(qtype)
+
+
 def validate_config(config):
-    """Validate config file"""
+    """Validate config file against CONFIG_SCHEMA"""
     errors = []
     if not isinstance(config, dict):
         errors.append("Top-level config must be a mapping/object.")
+        config = {}
 
-    for field in ["servers", "queries"]:
-        if field not in config:
-            errors.append(f"Missing required field: '{field}'")
-        elif not isinstance(config[field], list) or not config[field]:
-            errors.append(f"'{field}' must be a non-empty list.")
-
-    if "servers" in config:
-        for i, server in enumerate(config["servers"]):
-            if not isinstance(server, dict):
-                errors.append(f"servers[{i}] must be a mapping/object.")
-            else:
-                errors.extend(
-                    f"servers[{i}] missing field: '{f}'"
-                    for f in ["name", "address"]
-                    if f not in server
-                )
-    if "queries" in config:
-        for i, query in enumerate(config["queries"]):
-            if not isinstance(query, dict):
-                errors.append(f"queries[{i}] must be a mapping/object.")
-            else:
-                errors.extend(
-                    f"queries[{i}] missing field: '{f}'"
-                    for f in ["name", "type"]
-                    if f not in query
-                )
-    if "entrypoints" in config:
-        for i, entry in enumerate(config["entrypoints"]):
-            if not isinstance(entry, dict):
-                errors.append(f"entrypoints[{i}] must be a mapping/object.")
+    for section, (required, fields) in CONFIG_SCHEMA.items():
+        if section not in config:
+            if required:
+                errors.append(f"Missing required field: '{section}'")
+            continue
+        items = config[section]
+        if not isinstance(items, list) or (required and not items):
+            errors.append(
+                f"'{section}' must be a {'non-empty ' if required else ''}list."
+            )
+            continue
+        for i, item in enumerate(items):
+            if not isinstance(item, dict):
+                errors.append(f"{section}[{i}] must be a mapping/object.")
             else:
                 errors.extend(
-                    f"entrypoints[{i}] missing field: '{f}'"
-                    for f in ["name", "address"]
-                    if f not in entry
+                    f"{section}[{i}] missing field: '{f}'"
+                    for f in fields
+                    if f not in item
                 )
 
+    for section in ("servers", "entrypoints"):
+        items = config.get(section)
+        for i, item in enumerate(items if isinstance(items, list) else []):
+            if isinstance(item, dict) and not isinstance(item.get("address", ""), str):
+                errors.append(f"{section}[{i}] address must be a string.")
+
+    queries = config.get("queries")
+    for i, query in enumerate(queries if isinstance(queries, list) else []):
+        if not isinstance(query, dict):
+            continue
+        if "name" in query:
+            try:
+                parse_name(query["name"])
+            except (dns.exception.DNSException, TypeError):
+                errors.append(f"queries[{i}] has invalid name: '{query['name']}'")
+        if "type" in query:
+            try:
+                parse_type(query["type"])
+            except (dns.exception.DNSException, TypeError):
+                errors.append(f"queries[{i}] has unknown type: '{query['type']}'")
+
+    for field, (minimum, maximum) in INTEGER_FIELDS.items():
+        if field in config:
+            try:
+                value = int(config[field])
+            except (TypeError, ValueError, OverflowError):
+                errors.append(f"'{field}' must be an integer.")
+                continue
+            if value < minimum or (maximum is not None and value > maximum):
+                bounds = f">= {minimum}" if maximum is None else f"{minimum}-{maximum}"
+                errors.append(f"'{field}' must be an integer {bounds}.")
+    for field, minimum in NUMBER_FIELDS.items():
+        if field in config:
+            try:
+                value = float(config[field])
+            except (TypeError, ValueError):
+                value = math.nan
+            if not (math.isfinite(value) and value >= minimum):
+                errors.append(f"'{field}' must be a number >= {minimum}.")
+
     if errors:
         for err in errors:
             logger.error(f"CONFIG ERROR: {err}")
         raise ValueError("Config validation failed. See errors above.")
 
 
+# Prefer libyaml's C loader when PyYAML was built with it
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+_config_cache = {}  # path -> (mtime_ns, config)
+
+
 def load_config():
-    """Load and validate config file"""
+    """Load and validate config file, reusing the last result if unchanged"""
     try:
+        mtime = os.stat(CONFIG_FILE).st_mtime_ns
+        cached = _config_cache.get(CONFIG_FILE)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
         with open(CONFIG_FILE, "r", encoding="utf-8") as f:
-            config = yaml.safe_load(f)
+            config = yaml.load(f, Loader=YAML_LOADER)
             validate_config(config)
             logger.info(f"Loaded config from {CONFIG_FILE}")
-            return config
+        _config_cache[CONFIG_FILE] = (mtime, config)
+        return config
     except Exception as e:
         logger.exception(f"Failed to load or validate config: {e}")
         raise
 
 
-# --- DNS probe ---
-def probe_dns(server_addr, query, qtype):
-    """Resolve a DNS query, timing out after 5 seconds"""
-    resolver = dns.resolver.Resolver(configure=False)
-    resolver.nameservers = [server_addr]
-    try:
-        start = time.time()
-        resolver.resolve(query, qtype, lifetime=5)
-        duration = time.time() - start
-        logger.debug(f"Success: {query} ({qtype}) via {server_addr} in {duration:.3f}s")
-        return duration, False  # False = not failed
-    except Exception as e:
-        logger.warning(f"DNS probe failed: {query} ({qtype}) via {server_addr}: {e}")
-        return None, True  # True = failed
+# --- DNS transport ---
+class NameserverProtocol(asyncio.DatagramProtocol):
+    """A single UDP socket per nameserver, with queries pipelined by ID"""
 
+    __slots__ = ("address", "transport", "pending")
 
-class DNSTraceExporter:
-    def __init__(self, config):
-        self.config = config
-        self.reload_config()
-        self.metrics = {
-            "latency": Gauge(
+    def __init__(self, address):
+        self.address = address
+        self.transport = None
+        self.pending = {}  # txid -> (request, future)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # Room for a burst of pipelined replies, and a low-delay TOS hint
+        sock = transport.get_extra_info("socket")
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+            if sock.family == socket.AF_INET:
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, 0x10)
+            elif sock.family == socket.AF_INET6:
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_TCLASS, 0x10)
+        except OSError as e:
+            logger.debug("Could not tune socket for %s: %s", self.address, e)
+
+    def datagram_received(self, data, addr):
+        received = time.monotonic_ns()
+        if len(data) < 2:
+            return
+        (txid,) = struct.unpack_from("!H", data)
+        if txid not in self.pending:
+            return  # late reply to a query that already timed out
+        request, waiter = self.pending[txid]
+        try:
+            response = dns.message.from_wire(data)
+        except Exception:
+            return
+        if request.is_response(response) and not waiter.done():
+            del self.pending[txid]
+            waiter.set_result((response, received))
+
+    def error_received(self, exc):
+        # ICMP errors on a shared socket can't be tied to a single query
+        self.fail_pending(exc)
+
+    def connection_lost(self, exc):
+        self.fail_pending(exc or ConnectionError("socket closed"))
+
+    def fail_pending(self, exc):
+        for _, waiter in self.pending.values():
+            if not waiter.done():
+                waiter.set_exception(exc)
+        self.pending.clear()
+
+    async def query(self, request, timeout, lifetime):
+        """Send a query, resending it every `timeout` seconds until it is
+        answered or `lifetime` expires, and return (response, latency)"""
+        loop = asyncio.get_running_loop()
+        while request.id in self.pending:
+            request.id = dns.entropy.random_16()
+        waiter = loop.create_future()
+        self.pending[request.id] = (request, waiter)
+        try:
+            wire = request.to_wire()
+            start = time.monotonic_ns()
+            async with asyncio.timeout(lifetime):
+                while not waiter.done():
+                    self.transport.sendto(wire)
+                    await asyncio.wait([waiter], timeout=timeout)
+            response, received = waiter.result()
+        finally:
+            self.pending.pop(request.id, None)
+        return response, (received - start) / 1e9
+
+
+def check_answer(response):
+    """Raise the errors dns.resolver would for a response without an answer,
+    otherwise return the answer's TTL"""
+    rcode = response.rcode()
+    if rcode == dns.rcode.NXDOMAIN:
+        raise dns.resolver.NXDOMAIN(qnames=[response.question[0].name])
+    if rcode != dns.rcode.NOERROR:
+        raise dns.exception.DNSException(f"Server answered {dns.rcode.to_text(rcode)}")
+    # A truncated reply still proves the server answered
+    if response.flags & dns.flags.TC:
+        return 0
+    result = response.resolve_chaining()
+    if result.answer is None:
+        raise dns.resolver.NoAnswer(response=response)
+    return result.minimum_ttl
+
+
+@dataclass(slots=True, frozen=True)
+class ProbeResult:
+    """Outcome of a single probe; latency is None if the probe failed"""
+
+    latency: float | None
+
+    @property
+    def failed(self):
+        return self.latency is None
+
+
+class LatencyCollector(Collector):
+    """Exports the latest probe latencies, stored as plain dicts keyed by
+    label values, as gauges at scrape time"""
+
+    def __init__(self):
+        self.hops = {}  # (query_name, query_type, hop, hop_index) -> seconds
+        self.chains = {}  # (query_name, query_type) -> seconds
+        self.entrypoints = {}  # (query_name, query_type, entrypoint) -> seconds
+
+    def collect(self):
+        families = [
+            (
                 "dns_trace_latency_seconds",
                 "DNS Query Latency per Hop",
                 ["query_name", "query_type", "hop", "hop_index"],
+                self.hops,
             ),
-            "chain_latency": Gauge(
+            (
                 "dns_trace_chain_latency_seconds",
                 "Total DNS Query Chain Latency",
                 ["query_name", "query_type"],
+                self.chains,
             ),
-            "entrypoint_latency": Gauge(
+            (
                 "dns_trace_entrypoint_latency_seconds",
                 "DNS Query Entrypoint Latency",
                 ["query_name", "query_type", "entrypoint"],
+                self.entrypoints,
             ),
+        ]
+        for name, documentation, labels, values in families:
+            family = GaugeMetricFamily(name, documentation, labels=labels)
+            for label_values, value in values.items():
+                family.add_metric(label_values, value)
+            yield family
+
+
+class DNSTraceExporter:
+    __slots__ = (
+        "config",
+        "metrics",
+        "latencies",
+        "interval",
+        "listen_port",
+        "servers",
+        "queries",
+        "entrypoints",
+        "cache_max_ttl",
+        "probe_timeout",
+        "probe_total_timeout",
+        "max_concurrency",
+        "_endpoints",
+        "_cache",
+        "_questions",
+        "_concurrency",
+        "_cache_hit_child",
+        "_failed_child",
+        "_entrypoint_failed_child",
+        "_hop_labels",
+    )
+
+    def __init__(self, config):
+        self.config = config
+        self._endpoints = {}
+        self._cache = {}  # (server_addr, query, qtype) -> (expiry, latency)
+        # Latency gauges are recorded into plain dicts and only turned into
+        # samples when Prometheus scrapes
+        self.latencies = LatencyCollector()
+        REGISTRY.register(self.latencies)
+        self.metrics = {
             "probe_failed_total": Counter(
                 "dns_trace_probe_failed_total",
                 "Total failed DNS probes per Hop",
@@ -127,9 +345,17 @@ class DNSTraceExporter:
                 "Total failed DNS probes per Entrypoint",
                 ["query_name", "query_type", "entrypoint"],
             ),
+            "cache_hits_total": Counter(
+                "dns_trace_cache_hits_total",
+                "Total DNS probes answered from the TTL cache",
+                ["query_name", "query_type"],
+            ),
+            "cache_enabled": Gauge(
+                "dns_trace_cache_enabled",
+                "Whether hop latencies may be replayed from the TTL cache",
+            ),
         }
-        max_threads = max(4, len(self.queries) * len(self.servers))
-        self.executor = ThreadPoolExecutor(max_workers=max_threads)
+        self.reload_config()
 
     def reload_config(self):
         self.interval = int(self.config.get("interval", 30))
@@ -137,92 +363,249 @@ class DNSTraceExporter:
         self.servers = self.config["servers"]
         self.queries = self.config["queries"]
         self.entrypoints = self.config.get("entrypoints", [])
+        # Replay a hop's last latency until its answer TTL (capped) expires; 0 disables
+        self.cache_max_ttl = int(self.config.get("cache_max_ttl", 0))
+        self._cache.clear()
+        # Parsed question for each query, so probes skip name/type parsing
+        self._questions = {
+            (q["name"], q["type"]): (parse_name(q["name"]), parse_type(q["type"]))
+            for q in self.queries
+        }
+        # Per-attempt UDP timeout and overall budget for one probe
+        self.probe_timeout = max(
+            NUMBER_FIELDS["probe_timeout"], float(self.config.get("probe_timeout", 1.0))
+        )
+        self.probe_total_timeout = float(self.config.get("probe_total_timeout", 2.0))
+        # Cap on in-flight queries; further probes queue for a free slot
+        self.max_concurrency = max(1, int(self.config.get("max_concurrency", 64)))
+        self._concurrency = asyncio.Semaphore(self.max_concurrency)
+        self.metrics["cache_enabled"].set(1 if self.cache_max_ttl > 0 else 0)
+        self.bind_metrics()
 
-    def probe_chain(self, query):
-        # Probe all hops for a single query, in parallel
-        futures = []
-        results = {}
-        for idx, server in enumerate(self.servers):
-            future = self.executor.submit(
-                probe_dns, server["address"], query["name"], query["type"]
-            )
-            futures.append((idx, server, future))
-        chain_total = 0.0
-        for idx, server, fut in futures:
-            latency, failed = fut.result()
-            label_args = dict(
-                query_name=query["name"],
-                query_type=query["type"],
-                hop=server["name"],
-                hop_index=str(idx),
-            )
-            if not failed and latency is not None:
-                self.metrics["latency"].labels(**label_args).set(latency)
-                results[(server["name"], idx)] = latency
-                chain_total += latency
-            else:
-                self.metrics["probe_failed_total"].labels(**label_args).inc()
-                logger.debug(
-                    f"Probe failure counted: {query['name']} ({query['type']}) via {server['name']}"
+    def bind_metrics(self):
+        # Resolve label children once so the probe path skips .labels()
+        self._cache_hit_child = {}
+        self._failed_child = {}
+        self._entrypoint_failed_child = {}
+        # (query_name, query_type, hop, hop_index) label values per hop,
+        # frozen here so probes don't rebuild them
+        self._hop_labels = {}
+        for query in self.queries:
+            qkey = (query["name"], query["type"])
+            self._cache_hit_child[qkey] = self.metrics["cache_hits_total"].labels(*qkey)
+            for idx, server in enumerate(self.servers):
+                labels = (*qkey, server["name"], str(idx))
+                self._hop_labels[(*qkey, idx)] = labels
+                self._failed_child[(*qkey, idx)] = self.metrics[
+                    "probe_failed_total"
+                ].labels(*labels)
+            for entry in self.entrypoints:
+                self._entrypoint_failed_child[(*qkey, entry["name"])] = self.metrics[
+                    "entrypoint_probe_failed_total"
+                ].labels(*qkey, entry["name"])
+
+    async def open_endpoints(self):
+        # One socket per nameserver address, shared by hops and entrypoints
+        # and kept open across rounds; only missing or closed ones are opened
+        loop = asyncio.get_running_loop()
+        addresses = {server["address"] for server in self.servers}
+        addresses.update(entry["address"] for entry in self.entrypoints)
+        for address in addresses:
+            endpoint = self._endpoints.get(address)
+            if endpoint is not None and not endpoint.transport.is_closing():
+                continue
+            try:
+                _, self._endpoints[address] = await loop.create_datagram_endpoint(
+                    lambda: NameserverProtocol(address), remote_addr=(address, 53)
                 )
-        # Set total chain latency (only sum of successful hops)
-        self.metrics["chain_latency"].labels(
-            query_name=query["name"], query_type=query["type"]
-        ).set(chain_total)
-        logger.info(
-            f"Chain: {query['name']} ({query['type']}): total {chain_total:.3f}s | hops: {[f'{self.servers[i]['name']}:{l:.3f}s' for (n, i), l in results.items()]}"
-        )
+            except (OSError, TypeError, ValueError) as e:
+                # One unusable address must not stop the other probes
+                self._endpoints.pop(address, None)
+                logger.warning("Failed to open socket for %s: %s", address, e)
 
-    def probe_entrypoints(self, query):
-        for entry in self.entrypoints:
-            latency, failed = probe_dns(entry["address"], query["name"], query["type"])
-            label_args = dict(
-                query_name=query["name"],
-                query_type=query["type"],
-                entrypoint=entry["name"],
+    async def probe_dns(self, server_addr, query, qtype, use_cache=True):
+        """Resolve a DNS query, retrying until probe_total_timeout expires"""
+        key = (server_addr, query, qtype)
+        cached = self._cache.get(key) if use_cache else None
+        if cached is not None and time.monotonic() < cached[0]:
+            self._cache_hit_child[(query, qtype)].inc()
+            return ProbeResult(cached[1])
+        endpoint = self._endpoints.get(server_addr)
+        if endpoint is None:
+            # open_endpoints already logged why the socket couldn't be opened
+            logger.warning(
+                "DNS probe failed: %s (%s) via %s: no socket open for this server",
+                query,
+                qtype,
+                server_addr,
             )
-            if not failed and latency is not None:
-                self.metrics["entrypoint_latency"].labels(**label_args).set(latency)
-                logger.info(
-                    f"Entrypoint: {query['name']} ({query['type']}): {entry['name']} {latency:.3f}s"
+            return ProbeResult(None)
+        request = dns.message.make_query(*self._questions[(query, qtype)])
+        try:
+            async with self._concurrency:
+                response, duration = await endpoint.query(
+                    request, self.probe_timeout, self.probe_total_timeout
                 )
+            ttl = check_answer(response)
+            if use_cache and self.cache_max_ttl > 0:
+                expiry = time.monotonic() + min(ttl, self.cache_max_ttl)
+                self._cache[key] = (expiry, duration)
+            logger.debug(
+                "Success: %s (%s) via %s in %.3fs", query, qtype, server_addr, duration
+            )
+            return ProbeResult(duration)
+        except Exception as e:
+            logger.warning(
+                "DNS probe failed: %s (%s) via %s: %r", query, qtype, server_addr, e
+            )
+            return ProbeResult(None)
+
+    async def probe_chain(self, query):
+        # Probe all hops for a single query, concurrently
+        probes = await asyncio.gather(
+            *(
+                self.probe_dns(server["address"], query["name"], query["type"])
+                for server in self.servers
+            )
+        )
+        latencies = [0.0] * len(self.servers)
+        for idx, result in enumerate(probes):
+            key = (query["name"], query["type"], idx)
+            labels = self._hop_labels[key]
+            if not result.failed:
+                self.latencies.hops[labels] = result.latency
+                latencies[idx] = result.latency
             else:
-                self.metrics["entrypoint_probe_failed_total"].labels(**label_args).inc()
-                logger.debug(
-                    f"Entrypoint probe failure counted: {query['name']} ({query['type']}) via {entry['name']}"
-                )
+                self._failed_child[key].inc()
+                logger.debug("Probe failure counted: %s (%s) via %s", *labels[:3])
+        # Total chain latency is the sum of successful hops (failed ones stay 0)
+        chain_total = math.fsum(latencies)
+        self.latencies.chains[(query["name"], query["type"])] = chain_total
+        # The per-hop summary is only worth building if it will be emitted
+        if logger.isEnabledFor(logging.INFO):
+            hops = [
+                f"{server['name']}:{result.latency:.3f}s"
+                for server, result in zip(self.servers, probes)
+                if not result.failed
+            ]
+            logger.info(
+                "Chain: %s (%s): total %.3fs | hops: %s",
+                query["name"],
+                query["type"],
+                chain_total,
+                hops,
+            )
 
-    def run_probe(self):
+    async def probe_entrypoint(self, query, entry):
+        # Entrypoints always go to the wire so the end-to-end view
+        # reflects outages even while hop latencies are cached
+        result = await self.probe_dns(
+            entry["address"], query["name"], query["type"], use_cache=False
+        )
+        key = (query["name"], query["type"], entry["name"])
+        if not result.failed:
+            self.latencies.entrypoints[key] = result.latency
+            logger.info(
+                "Entrypoint: %s (%s): %s %.3fs",
+                query["name"],
+                query["type"],
+                entry["name"],
+                result.latency,
+            )
+        else:
+            self._entrypoint_failed_child[key].inc()
+            logger.debug(
+                "Entrypoint probe failure counted: %s (%s) via %s",
+                query["name"],
+                query["type"],
+                entry["name"],
+            )
+
+    async def run_probe(self):
         logger.info("Starting probe round.")
-        futures = []
-        for query in self.queries:
-            # Each query chain is independent, so can be parallelized too
-            fut = self.executor.submit(self.probe_chain, query)
-            futures.append(fut)
-            self.probe_entrypoints(query)
-        # Wait for all query chains to finish
-        for _ in as_completed(futures):
-            pass
+        await self.open_endpoints()
+        # Each query chain and each (query, entrypoint) probe is independent,
+        # so they all share the event loop concurrently
+        outcomes = await asyncio.gather(
+            *(self.probe_chain(query) for query in self.queries),
+            *(
+                self.probe_entrypoint(query, entry)
+                for query in self.queries
+                for entry in self.entrypoints
+            ),
+            return_exceptions=True,
+        )
+        for outcome in outcomes:
+            if isinstance(outcome, Exception):
+                logger.error("Probe task failed:", exc_info=outcome)
         logger.info("Probe round complete.")
 
-    def loop(self):
+    async def probe_forever(self):
+        # Start rounds on a fixed tick so the period doesn't drift by the
+        # time each round takes
+        next_tick = time.monotonic()
         while True:
             try:
-                self.run_probe()
+                await self.run_probe()
             except Exception:
                 logger.exception("Error during probe round:")
-            time.sleep(self.interval)
+            next_tick += self.interval
+            now = time.monotonic()
+            if next_tick < now:
+                # The round overran its tick: start the next one straight
+                # away instead of bursting through the missed ticks
+                next_tick = now
+            await asyncio.sleep(next_tick - now)
+
+
+# --- Metrics endpoint ---
+async def serve_metrics(reader, writer):
+    """Answer a single HTTP request with the current metrics"""
+    try:
+        async with asyncio.timeout(10):
+            request_line = await reader.readline()
+            headers = {}
+            while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+        if not request_line:
+            return
+        method = request_line.split(b" ", 1)[0]
+        # Like prometheus_client's own server, every path serves metrics, in
+        # the format and encoding the scraper asked for
+        try:
+            encoder, content_type = choose_encoder(headers.get("accept"))
+            body = encoder(REGISTRY)
+        except Exception:
+            # Answer with an error so Prometheus records a failed scrape
+            logger.exception("Failed to render metrics:")
+            status = "500 Internal Server Error"
+            content_type = "text/plain; charset=utf-8"
+            body = b"Failed to render metrics\n"
+        else:
+            status = "200 OK"
+        head = f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+        if status == "200 OK" and gzip_accepted(headers.get("accept-encoding")):
+            body = gzip.compress(body)
+            head += "Content-Encoding: gzip\r\n"
+        head += f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+        writer.write(head.encode() + (b"" if method == b"HEAD" else body))
+        await writer.drain()
+    except (OSError, TimeoutError, ValueError) as e:
+        # ValueError: a request or header line longer than the reader's limit
+        logger.debug("Metrics request failed: %r", e)
+    finally:
+        writer.close()
 
 
-def main():
+async def main():
     config = load_config()
     exporter = DNSTraceExporter(config)
-    start_http_server(exporter.listen_port)
+    # Metrics are served from the same event loop as the probes
+    await asyncio.start_server(serve_metrics, port=exporter.listen_port)
     logger.info(f"Exporter running, metrics at :{exporter.listen_port}/metrics")
-    t = threading.Thread(target=exporter.loop)
-    t.start()
-    t.join()
+    await exporter.probe_forever()
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())